@@ -3,18 +3,28 @@ Simplified AI Programming Tutor for Hugging Face Spaces
 Optimized to avoid permission errors and work reliably on HF Spaces
 """
 
+import importlib.util
 import streamlit as st
 import os
 
-# Try to import the fine-tuned model components
-try:
-    from fine import ProgrammingEducationAI, ComprehensiveFeedback
-    MODEL_AVAILABLE = True
-except Exception as e:
-    MODEL_AVAILABLE = False
+# Only probe for the fine-tuned model module here; importing it pulls in
+# torch and transformers, which is deferred until the model is first used
+MODEL_AVAILABLE = importlib.util.find_spec("fine") is not None
 
 # Note: Using public model - no HF_TOKEN required
 HF_TOKEN = None
+MODEL_PATH = "FaroukTomori/codellama-7b-programming-education"
+
+
+@st.cache_resource
+def get_ai_tutor(model_path: str):
+    """Load the fine-tuned model once per process and share it across sessions"""
+    from fine import ProgrammingEducationAI
+
+    ai_tutor = ProgrammingEducationAI(model_path)
+    ai_tutor.load_model()
+    return ai_tutor
+
 
 st.title("🤖 AI Programming Tutor")
 st.write("### Full AI Model Version - Shows Detailed Errors")
@@ -25,11 +35,11 @@ with st.sidebar:
     if MODEL_AVAILABLE:
         st.success("✅ Fine-tuned model available")
         st.success("🌐 Using public model - no authentication required")
-        st.info(f"📁 Model path: FaroukTomori/codellama-7b-programming-education")
+        st.info(f"📁 Model path: {MODEL_PATH}")
     else:
         st.error("❌ Fine-tuned model not available")
-        st.error(f"🔍 Import error: {e}")
-        st.info("💡 Check the import error above to fix the issue")
+        st.error("🔍 fine.py was not found next to this app")
+        st.info("💡 Add fine.py to the Space to enable the model")
 
 code = st.text_area("Enter your code:", height=200)
 
@@ -40,19 +50,13 @@ if st.button("Analyze with AI Model", type="primary"):
 
     if not MODEL_AVAILABLE:
         st.error("❌ Cannot analyze - fine-tuned model components not available")
-        st.error("🔍 Check the import error in the sidebar")
+        st.error("🔍 fine.py was not found next to this app")
         return
 
     with st.spinner("🤖 Loading AI model..."):
         try:
-            # Load the fine-tuned model
-            model_path = "FaroukTomori/codellama-7b-programming-education"
-            st.info(f"🔍 Attempting to load model from: {model_path}")
-
-            ai_tutor = ProgrammingEducationAI(model_path)
-            st.success("✅ Model class instantiated successfully")
-
-            ai_tutor.load_model()
+            # Load the fine-tuned model (cached after the first click)
+            ai_tutor = get_ai_tutor(MODEL_PATH)
             st.success("✅ Model loaded successfully!")
 
             # Generate feedback
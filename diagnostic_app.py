@@ -3,6 +3,8 @@ Diagnostic App - Find out why the full model isn't working
 """
 
 import streamlit as st
+import ast
+import importlib.util
 import os
 import sys
 
@@ -49,15 +51,35 @@ try:
 except ImportError as e:
     st.error(f"❌ Accelerate: {e}")
 
+
+@st.cache_resource
+def import_fine_components():
+    """Import the fine-tuned model components once per process"""
+    from fine import ProgrammingEducationAI, ComprehensiveFeedback
+    return ProgrammingEducationAI, ComprehensiveFeedback
+
+
+@st.cache_resource
+def find_fine_classes(fine_path: str, mtime: float) -> set:
+    """Parse fine.py once and return the names of the classes it defines"""
+    with open(fine_path, 'rb') as f:
+        tree = ast.parse(f.read())
+    return {node.name for node in ast.walk(tree) if isinstance(node, ast.ClassDef)}
+
+
 # Check 3: Fine-tuned model components
 st.subheader("3. Fine-tuned Model Components")
-try:
-    from fine import ProgrammingEducationAI, ComprehensiveFeedback
-    st.success("✅ Fine-tuned model components imported successfully")
-    MODEL_AVAILABLE = True
-except Exception as e:
-    st.error(f"❌ Fine-tuned model components failed: {e}")
+if importlib.util.find_spec("fine") is None:
+    st.error("❌ Fine-tuned model components failed: module 'fine' not found")
     MODEL_AVAILABLE = False
+else:
+    try:
+        ProgrammingEducationAI, ComprehensiveFeedback = import_fine_components()
+        st.success("✅ Fine-tuned model components imported successfully")
+        MODEL_AVAILABLE = True
+    except Exception as e:
+        st.error(f"❌ Fine-tuned model components failed: {e}")
+        MODEL_AVAILABLE = False
 
 # Check 4: Environment variables
 st.subheader("4. Environment Variables")
@@ -90,19 +112,18 @@ if os.path.exists(fine_path):
     file_size = os.path.getsize(fine_path)
     st.write(f"**File size:** {file_size:,} bytes")
 
-    # Check if it has the required classes
+    # Check if it has the required classes (parsed once per file version)
     try:
-        with open(fine_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-            if "class ProgrammingEducationAI" in content:
-                st.success("✅ ProgrammingEducationAI class found")
-            else:
-                st.error("❌ ProgrammingEducationAI class not found")
-
-            if "class ComprehensiveFeedback" in content:
-                st.success("✅ ComprehensiveFeedback class found")
-            else:
-                st.error("❌ ComprehensiveFeedback class not found")
+        classes = find_fine_classes(fine_path, os.path.getmtime(fine_path))
+        if "ProgrammingEducationAI" in classes:
+            st.success("✅ ProgrammingEducationAI class found")
+        else:
+            st.error("❌ ProgrammingEducationAI class not found")
+
+        if "ComprehensiveFeedback" in classes:
+            st.success("✅ ComprehensiveFeedback class found")
+        else:
+            st.error("❌ ComprehensiveFeedback class not found")
     except Exception as e:
         st.error(f"❌ Error reading fine.py: {e}")
 else:
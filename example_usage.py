@@ -5,6 +5,11 @@ Example Usage of the Comprehensive Educational Feedback System
 from fine import ProgrammingEducationAI
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def main():
     print("🎓 Comprehensive Educational Feedback System")
@@ -176,8 +181,13 @@ def save_feedback_to_json(feedback, filename):
         "estimated_time_to_improve": feedback.estimated_time_to_improve
     }
 
-    with open(filename, 'w') as f:
-        json.dump(feedback_dict, f, indent=2)
+    if orjson is not None:
+        # orjson encodes straight to bytes, so write in binary mode
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(feedback_dict, option=orjson.OPT_INDENT_2))
+    else:
+        with open(filename, 'w') as f:
+            json.dump(feedback_dict, f, indent=2)
 
     print(f"💾 Feedback saved to {filename}")
 
@@ -23,27 +23,62 @@ Author: [Your Name]
 Date: [Current Date]
 """
 
+import ast
+import builtins
+import copy
+import fnmatch
+import functools
 import re
-from dataclasses import dataclass
-from typing import Dict, List, Optional, Tuple
+import threading
+from collections import Counter
+from dataclasses import dataclass, replace
+from typing import Dict, Iterator, List, Optional, Tuple
 import logging
 import json
-from transformers import AutoTokenizer, AutoModelForCausalLM
 import os
+
+# Size the OpenMP/MKL pools for the 2 vCPU HF Spaces target; these are read
+# when torch loads, so they must be set before it is imported
+CPU_THREADS = os.getenv("CPU_THREADS", "2")
+os.environ.setdefault("OMP_NUM_THREADS", CPU_THREADS)
+os.environ.setdefault("MKL_NUM_THREADS", CPU_THREADS)
+
+from huggingface_hub import list_repo_files, snapshot_download
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    BitsAndBytesConfig,
+    DynamicCache,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
 import gc
 import torch
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
 # --- Critical Environment Setup (Must be before imports) ---
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 os.environ["DATASETS_DISABLE_MULTIPROCESSING"] = "1"
+# Persist Inductor kernels between restarts so torch.compile only pays once
+os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", "torchinductor_cache")
 
-# Clear any existing CUDA cache (only if CUDA is available)
+# Allocator settings are read when CUDA initializes, so set them at import;
+# clearing the cache is left to clear_cuda_cache() after a model is dropped
 if torch.cuda.is_available():
-    os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "max_split_size_mb:128,garbage_collection_threshold:0.6"
-    torch.cuda.empty_cache()
-    gc.collect()
+    os.environ["PYTORCH_CUDA_ALLOC_CONF"] = \
+        "expandable_segments:True,max_split_size_mb:128,garbage_collection_threshold:0.6"
 
 
 # Configure logging
@@ -52,17 +87,20 @@ logger = logging.getLogger(__name__)
 
 
 def clear_cuda_cache():
-    """Clear CUDA cache and run garbage collection"""
+    """Run garbage collection, then return the freed CUDA blocks to the driver"""
+    # Collect first so tensors of dropped objects are freed before emptying
+    gc.collect()
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
         torch.cuda.synchronize()
-    gc.collect()
 
 
 def get_system_memory():
     """Get system memory information"""
+    if psutil is None:
+        print("Could not get system memory info: psutil is not installed")
+        return
     try:
-        import psutil
         memory = psutil.virtual_memory()
         print(
             f"System RAM: {memory.used / (1024**3):.1f}GB / {memory.total / (1024**3):.1f}GB used ({memory.percent:.1f}%)")
@@ -70,6 +108,22 @@ def get_system_memory():
         print(f"Could not get system memory info: {e}")
 
 
+def parse_json(text: str):
+    """
+    Parse the first JSON object in text, using orjson when installed
+
+    Any prose the model writes around the object is ignored. Raises
+    json.JSONDecodeError when the text holds no valid object.
+    """
+    span = json_object_span(text)
+    if span is not None:
+        text = text[span[0]:span[1]]
+    if orjson is not None:
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError
+        return orjson.loads(text)
+    return json.loads(text)
+
+
 def get_gpu_memory():
     """Get GPU memory information (if available)"""
     if torch.cuda.is_available():
@@ -88,7 +142,7 @@ def get_gpu_memory():
         print("No GPU available - using CPU only")
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class CodeFeedback:
     """Data structure for storing code feedback"""
     code_snippet: str
@@ -99,7 +153,7 @@ class CodeFeedback:
     learning_objectives: List[str] = None
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ComprehensiveFeedback:
     """Comprehensive feedback structure with all educational components"""
     code_snippet: str
@@ -130,29 +184,288 @@ class ComprehensiveFeedback:
     estimated_time_to_improve: str
 
 
+# The free-text prompts end with "Feedback:"; the model repeating it means
+# it has finished its answer and started a new round
+FEEDBACK_STOP_STRINGS = ["\n\nFeedback:"]
+
+
+def json_object_span(text: str) -> Optional[Tuple[int, int]]:
+    """Find the (start, end) slice of the first complete top-level JSON object (single pass)"""
+    depth = 0
+    start = 0
+    in_string = False
+    escaped = False
+    for index, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"' and depth > 0:
+            in_string = True
+        elif char == "{":
+            if depth == 0:
+                start = index
+            depth += 1
+        elif char == "}" and depth > 0:
+            depth -= 1
+            if depth == 0:
+                return start, index + 1
+    return None
+
+
+def json_object_complete(text: str) -> bool:
+    """Check whether text contains a complete top-level JSON object (single pass)"""
+    return json_object_span(text) is not None
+
+
+class JSONBalancedBracesCriteria(StoppingCriteria):
+    """Stop generation once each sequence has emitted a complete JSON object"""
+
+    def __init__(self, tokenizer, prompt_length: int, check_every: int = 8):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.check_every = check_every
+        self._last_checked = 0
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        generated = input_ids.shape[1] - self.prompt_length
+        # Decoding is not free, so only look every few tokens. Assisted and
+        # prompt-lookup decoding add a variable number of tokens per step, so
+        # count from the last check rather than testing for multiples
+        if generated - self._last_checked < self.check_every:
+            return done
+        self._last_checked = generated
+
+        texts = self.tokenizer.batch_decode(
+            input_ids[:, self.prompt_length:], skip_special_tokens=True)
+        for i, text in enumerate(texts):
+            done[i] = json_object_complete(text)
+        return done
+
+
+class _EducationVisitor(ast.NodeVisitor):
+    """Collect everything the rule-based fallback checks need in one tree walk"""
+
+    SHORT_NAMES = {"x", "y", "z"}
+    BUILTIN_NAMES = frozenset(dir(builtins))
+
+    def __init__(self):
+        self.infinite_loops = 0
+        self.assigned_names = set()
+        self.used_names = set()
+        self.loop_targets = set()
+        self.defined_names = set()
+        self.imported_names = set()
+        self.star_import = False
+        self.zero_divisions = 0
+        self.short_names = set()
+        self.for_depth = 0
+        self.max_for_depth = 0
+
+    def visit_Import(self, node: ast.Import):
+        for alias in node.names:
+            self.imported_names.add(alias.asname or alias.name.split(".")[0])
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        if node.module == "__future__":
+            return
+        for alias in node.names:
+            if alias.name == "*":
+                self.star_import = True
+            else:
+                self.imported_names.add(alias.asname or alias.name)
+
+    def visit_FunctionDef(self, node: ast.FunctionDef):
+        self.defined_names.add(node.name)
+        self.generic_visit(node)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_ClassDef = visit_FunctionDef
+
+    def visit_ExceptHandler(self, node: ast.ExceptHandler):
+        if node.name:
+            self.defined_names.add(node.name)
+        self.generic_visit(node)
+
+    def visit_MatchAs(self, node: ast.AST):
+        if node.name:
+            self.defined_names.add(node.name)
+        self.generic_visit(node)
+
+    visit_MatchStar = visit_MatchAs
+
+    def visit_MatchMapping(self, node: ast.AST):
+        if node.rest:
+            self.defined_names.add(node.rest)
+        self.generic_visit(node)
+
+    def visit_BinOp(self, node: ast.BinOp):
+        if isinstance(node.op, (ast.Div, ast.FloorDiv, ast.Mod)) \
+                and isinstance(node.right, ast.Constant) and node.right.value == 0:
+            self.zero_divisions += 1
+        self.generic_visit(node)
+
+    def visit_While(self, node: ast.While):
+        if isinstance(node.test, ast.Constant) and node.test.value is True \
+                and not self._loop_can_exit(node):
+            self.infinite_loops += 1
+        self.generic_visit(node)
+
+    def visit_For(self, node: ast.For):
+        self._add_loop_targets(node.target)
+        self.for_depth += 1
+        self.max_for_depth = max(self.max_for_depth, self.for_depth)
+        self.generic_visit(node)
+        self.for_depth -= 1
+
+    visit_AsyncFor = visit_For
+
+    def visit_comprehension(self, node: ast.comprehension):
+        self._add_loop_targets(node.target)
+        self.generic_visit(node)
+
+    def visit_Name(self, node: ast.Name):
+        if isinstance(node.ctx, ast.Store):
+            self.assigned_names.add(node.id)
+        else:
+            self.used_names.add(node.id)
+        if node.id in self.SHORT_NAMES:
+            self.short_names.add(node.id)
+
+    def visit_AugAssign(self, node: ast.AugAssign):
+        # total += x reads total before storing it
+        if isinstance(node.target, ast.Name):
+            self.used_names.add(node.target.id)
+        self.generic_visit(node)
+
+    def visit_arg(self, node: ast.arg):
+        self.defined_names.add(node.arg)
+        if node.arg in self.SHORT_NAMES:
+            self.short_names.add(node.arg)
+        self.generic_visit(node)
+
+    def unused_names(self) -> set:
+        """Names assigned but never read; loop variables and _-prefixed names don't count"""
+        return {name for name in self.assigned_names - self.used_names - self.loop_targets
+                if not name.startswith("_")}
+
+    def undefined_names(self) -> set:
+        """
+        Names read but never bound anywhere in the code
+
+        Scopes are not tracked, so this only catches names bound nowhere (typos,
+        missing imports); a star import disables the check.
+        """
+        if self.star_import:
+            return set()
+        bound = (self.assigned_names | self.loop_targets | self.defined_names
+                 | self.imported_names | self.BUILTIN_NAMES)
+        return {name for name in self.used_names - bound
+                if not (name.startswith("__") and name.endswith("__"))}
+
+    def unused_imports(self) -> set:
+        """Imported names that are never read"""
+        return self.imported_names - self.used_names
+
+    def _add_loop_targets(self, target: ast.AST):
+        """Record the names bound by a for loop or comprehension target"""
+        self.loop_targets.update(
+            node.id for node in ast.walk(target) if isinstance(node, ast.Name))
+
+    @staticmethod
+    def _loop_can_exit(loop: ast.While) -> bool:
+        """Whether the loop body has a break or return that leaves this loop"""
+        stack = list(loop.body)
+        while stack:
+            node = stack.pop()
+            if isinstance(node, (ast.Break, ast.Return)):
+                return True
+            # A break in a nested loop or function does not exit this loop
+            if isinstance(node, (ast.For, ast.AsyncFor, ast.While, ast.FunctionDef,
+                                 ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+                continue
+            stack.extend(ast.iter_child_nodes(node))
+        return False
+
+
 class ProgrammingEducationAI:
     """
     Main class for the fine-tuned CodeLlama model for programming education
     """
 
-    def __init__(self, model_path: str = "TomoriFarouk/codellama-7b-programming-education"):
+    # Rule-based fallback patterns, compiled once per process
+    _SYNTAX_PATTERNS = [
+        (re.compile(r"print\s*\([^)]*\)\s*$"),
+         "Remember to add a colon after print statements in some contexts"),
+        (re.compile(r"if\s+[^:]+$"), "Don't forget the colon after your if condition"),
+        (re.compile(r"for\s+[^:]+$"), "Don't forget the colon after your for loop"),
+    ]
+    # Code that does not parse falls back to substring matching: every
+    # substring the logic/optimization/style checks look for, matched in a
+    # single pass. "x = " precedes the bare letters so an assignment is not
+    # also counted as a use of x.
+    _FALLBACK_TOKEN_RE = re.compile(r"while True:|break|in range|for|x = |[xyz]")
+
+    # With the clean code shortcut enabled, clean code up to this many lines
+    # gets comprehensive feedback without running the model
+    CLEAN_CODE_MAX_LINES = 30
+
+    # Prompt tokens kept free after the shared comprehensive feedback prefix
+    # for the task prompt (JSON format plus the issues and learning points)
+    TASK_PROMPT_TOKENS = 512
+
+    def __init__(self, model_path: str = "TomoriFarouk/codellama-7b-programming-education",
+                 quantization: Optional[str] = None,
+                 assistant_model_path: Optional[str] = None,
+                 clean_code_shortcut: bool = False):
         """
         Initialize the fine-tuned model and tokenizer
 
         Args:
             model_path: Path to your fine-tuned CodeLlama-7B model
+            quantization: Optional weight-only quantization ('8bit' or '4bit' NF4),
+                requires bitsandbytes
+            assistant_model_path: Optional small draft model sharing the tokenizer,
+                used for speculative decoding of the comprehensive feedback
+                (defaults to the ASSISTANT_MODEL_PATH environment variable)
+            clean_code_shortcut: Answer comprehensive feedback for short code that
+                passes every rule-based check with canned feedback instead of the
+                model (also enabled by CLEAN_CODE_SHORTCUT=1)
         """
+        if quantization not in (None, "8bit", "4bit"):
+            raise ValueError(f"Unsupported quantization: {quantization}")
         self.model_path = model_path
+        self.quantization = quantization
+        self.assistant_model_path = assistant_model_path or os.getenv(
+            "ASSISTANT_MODEL_PATH")
         self.tokenizer = None
         self.model = None
+        self.assistant_model = None
+        self.clean_code_shortcut = clean_code_shortcut or os.getenv(
+            "CLEAN_CODE_SHORTCUT") == "1"
+        # Prompt token budget; load_model lowers it to leave room for
+        # max_new_tokens within the model's context window
+        self.max_input_tokens = 2048
+        self.truncated_prompts = 0
+        # Comprehensive feedback requests answered without the model, to tune
+        # CLEAN_CODE_MAX_LINES against the total
+        self.comprehensive_requests = 0
+        self.clean_code_shortcuts = 0
         self.feedback_templates = self._load_feedback_templates()
         self.code_review_prompt_template = self._load_code_review_prompt()
         self.code_feedback_prompt_template = self._load_code_feedback_prompt()
+        self.shared_context_prompt = self._load_shared_context_prompt()
         self.comprehensive_feedback_prompt = self._load_comprehensive_feedback_prompt()
         self.comprehension_question_prompt = self._load_comprehension_question_prompt()
         self.code_fix_prompt = self._load_code_fix_prompt()
 
-    def _load_code_review_prompt(self) -> str:
+    @staticmethod
+    @functools.cache
+    def _load_code_review_prompt() -> str:
         """Load the code review prompt template used during fine-tuning"""
         return """You are an expert programming tutor. Review the following student code and provide educational feedback.
 
@@ -170,7 +483,9 @@ Please provide:
 
 Feedback:"""
 
-    def _load_code_feedback_prompt(self) -> str:
+    @staticmethod
+    @functools.cache
+    def _load_code_feedback_prompt() -> str:
         """Load the code feedback prompt template used during fine-tuning"""
         return """You are a helpful programming tutor. The student has written this code:
 
@@ -186,8 +501,10 @@ Provide constructive, educational feedback that helps the student learn. Focus o
 
 Feedback:"""
 
-    def _load_feedback_templates(self) -> Dict[str, str]:
-        """Load predefined feedback templates for different scenarios"""
+    @staticmethod
+    @functools.cache
+    def _load_feedback_templates() -> Dict[str, str]:
+        """Load predefined feedback templates for different scenarios (shared, do not mutate)"""
         return {
             "syntax_error": "I notice there's a syntax issue in your code. {error_description}. "
             "Here's what's happening: {explanation}. "
@@ -218,9 +535,20 @@ Feedback:"""
             # Get HF token for private model access
             hf_token = os.getenv("HF_TOKEN", None)
 
+            # Avoid oversubscribing the small CPU box: one intra-op thread per
+            # vCPU and no extra inter-op pool fighting it for cores
+            torch.set_num_threads(int(os.environ["OMP_NUM_THREADS"]))
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                # Can only be set before any inter-op work has started
+                pass
+
+            model_files = self._download_model_files(hf_token)
+
             logger.info("Loading tokenizer...")
             self.tokenizer = AutoTokenizer.from_pretrained(
-                self.model_path,
+                model_files,
                 trust_remote_code=True,
                 token=hf_token  # Use token for private models
             )
@@ -229,38 +557,163 @@ Feedback:"""
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
                 self.tokenizer.pad_token_id = self.tokenizer.eos_token_id
+            # Left padding keeps the last prompt token aligned for batched generate
+            self.tokenizer.padding_side = "left"
 
             logger.info(
                 f"Tokenizer loaded - Vocab size: {len(self.tokenizer)}")
 
+            # Optional bitsandbytes weight-only quantization (CUDA GPUs only):
+            # INT8 cuts weight memory ~2x and NF4 ~4x vs BF16, so the 7B model
+            # fits on a small GPU
+            quantization_config = None
+            device_map = None  # Force CPU for HF Spaces
+            if self.quantization == "8bit":
+                logger.info("Using 8-bit weight-only quantization")
+                quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+                device_map = "auto"
+            elif self.quantization == "4bit":
+                # NF4 with BF16 compute fits a 7B model in ~4GB, e.g. lab GPUs
+                logger.info("Using 4-bit NF4 weight-only quantization")
+                quantization_config = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_compute_dtype=torch.bfloat16,
+                    bnb_4bit_use_double_quant=True
+                )
+                device_map = "auto"
+
             # Load model optimized for HF Spaces (16GB RAM, 2 vCPU)
+            # BF16 halves the weight bytes read per decoded token vs FP32
+            # and keeps the FP32 exponent range, so no rescaling is needed
             print("Loading model optimized for HF Spaces (16GB RAM, 2 vCPU)...")
             self.model = AutoModelForCausalLM.from_pretrained(
-                self.model_path,
-                torch_dtype=torch.float32,
-                device_map=None,  # Force CPU for HF Spaces
+                model_files,
+                torch_dtype=torch.bfloat16,
+                device_map=device_map,
+                quantization_config=quantization_config,
                 low_cpu_mem_usage=True,
                 trust_remote_code=True,
                 offload_folder="offload",  # Offload to disk if needed
                 token=hf_token  # Use token for private models
             )
-            # Enable gradient checkpointing for memory savings
-            self.model.gradient_checkpointing_enable()
+
+            # Inference only: keep dropout off regardless of the checkpoint's mode
+            self.model.eval()
+
+            self.max_input_tokens = min(
+                2048, self.model.config.max_position_embeddings - 512)
+
+            if self.assistant_model_path:
+                logger.info(
+                    f"Loading assistant model from {self.assistant_model_path}...")
+                self.assistant_model = AutoModelForCausalLM.from_pretrained(
+                    self.assistant_model_path,
+                    torch_dtype=torch.bfloat16,
+                    low_cpu_mem_usage=True,
+                    trust_remote_code=True,
+                    token=hf_token
+                )
+                self.assistant_model.eval()
+
+            # Opt-in: compilation takes minutes on small CPU boxes
+            if os.getenv("TORCH_COMPILE") == "1":
+                self._compile_model()
 
             logger.info("Fine-tuned model loaded successfully")
-            logger.info(f"Model loaded on devices: {self.model.hf_device_map}")
+            logger.info(
+                f"Model loaded on devices: {getattr(self.model, 'hf_device_map', 'cpu')}")
 
         except Exception as e:
             logger.error(f"Error loading fine-tuned model: {e}")
             raise
 
-    def generate_code_review(self, code: str, student_level: str = "beginner") -> str:
+    def _download_model_files(self, hf_token: Optional[str]) -> str:
+        """
+        Download the model repo with parallel workers and return its local path
+
+        from_pretrained fetches shards one after another; snapshot_download
+        fetches them concurrently. Local paths are returned unchanged, and on
+        any download error loading falls back to from_pretrained's own fetch.
+        """
+        if os.path.isdir(self.model_path):
+            return self.model_path
+
+        try:
+            # Only what from_pretrained reads: configs, tokenizer, remote code
+            # and one weight format. Hub patterns use fnmatch, where "*" also
+            # matches "/", so they are resolved to top-level file names here
+            # to leave checkpoint-*/ folders out
+            files = list_repo_files(self.model_path, token=hf_token)
+            weights = "*.safetensors" if any(
+                f.endswith(".safetensors") for f in files) else "*.bin"
+            patterns = ["*.json", weights, "tokenizer.model", "*.py"]
+            allow_patterns = [f for f in files if "/" not in f and any(
+                fnmatch.fnmatch(f, pattern) for pattern in patterns)]
+
+            logger.info(f"Downloading {self.model_path} with parallel workers...")
+            return snapshot_download(
+                self.model_path,
+                allow_patterns=allow_patterns,
+                max_workers=8,
+                token=hf_token
+            )
+        except Exception as e:
+            logger.warning(f"Parallel download failed, loading directly: {e}")
+            return self.model_path
+
+    def _compile_model(self):
+        """Compile the model forward with torch.compile and warm it up"""
+        logger.info("Compiling model forward with torch.compile...")
+        # Compile the forward, not the module: generate() calls the
+        # underlying module, so a wrapped OptimizedModule would be bypassed.
+        # dynamic=True: prompt and cache lengths change every request and
+        # step, so shape-specialized graphs would keep recompiling
+        self.model.forward = torch.compile(
+            self.model.forward, mode="reduce-overhead", fullgraph=False, dynamic=True)
+
+        # Trigger compilation now so the first real request doesn't pay for it
+        warmup_ids = self.tokenizer("warmup", return_tensors="pt").input_ids
+        with torch.inference_mode():
+            self.model.generate(
+                warmup_ids,
+                max_new_tokens=4,
+                pad_token_id=self.tokenizer.eos_token_id
+            )
+        logger.info("Model compiled and warmed up")
+
+    def prewarm_cuda_allocator(self):
+        """
+        Grow the CUDA caching allocator with a full-length dummy forward
+
+        The blocks stay cached after the pass, so the first real requests reuse
+        them instead of stalling on cudaMalloc. Call after any empty_cache().
+        """
+        # CPU-only loads (device_map=None) leave the weights off the GPU even
+        # when one is present
+        device = next(self.model.parameters()).device
+        if device.type != "cuda":
+            return
+
+        dummy_ids = torch.full(
+            (1, self.max_input_tokens), self.tokenizer.pad_token_id,
+            dtype=torch.long, device=device)
+        with torch.inference_mode():
+            self.model(dummy_ids, use_cache=True)
+        del dummy_ids
+        torch.cuda.synchronize()
+        logger.info(
+            f"CUDA allocator prewarmed: {torch.cuda.memory_reserved() / (1024**3):.2f}GB reserved")
+
+    def generate_code_review(self, code: str, student_level: str = "beginner",
+                             max_input_tokens: Optional[int] = None) -> str:
         """
         Generate code review using the fine-tuned model
 
         Args:
             code: Student's code to review
             student_level: Student's skill level
+            max_input_tokens: Prompt token budget (defaults to self.max_input_tokens)
 
         Returns:
             Generated code review feedback
@@ -268,33 +721,73 @@ Feedback:"""
         if not self.model or not self.tokenizer:
             raise ValueError("Model not loaded. Call load_model() first.")
 
-        # Format the prompt using the template from fine-tuning
-        prompt = self.code_review_prompt_template.format(
-            code=code,
-            level=student_level
-        )
-
-        # Tokenize input
-        inputs = self.tokenizer(
-            prompt, return_tensors="pt", truncation=True, max_length=2048)
+        # Build the prompt ids from the template from fine-tuning
+        _, input_ids = self._fit_prompt_to_budget(
+            self.code_review_prompt_template, code, student_level,
+            max_input_tokens or self.max_input_tokens)
 
         # Generate response
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs = self.model.generate(
-                inputs.input_ids,
+                input_ids,
                 max_new_tokens=512,
-                temperature=0.7,
-                do_sample=True,
+                do_sample=False,  # Greedy: deterministic, no sampling overhead
+                num_beams=1,
+                stop_strings=FEEDBACK_STOP_STRINGS,
+                tokenizer=self.tokenizer,
                 pad_token_id=self.tokenizer.eos_token_id
             )
 
-        # Decode response
-        response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+        # Decode only the generated part (after the prompt)
+        generated_text = self.tokenizer.decode(
+            outputs[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+        return self._strip_stop_strings(generated_text)
 
-        # Extract only the generated part (after the prompt)
-        generated_text = response[len(prompt):].strip()
+    def _fit_prompt_to_budget(self, template: str, code: str, student_level: str,
+                              max_input_tokens: int) -> Tuple[str, torch.Tensor]:
+        """
+        Tokenize a {code}/{level} prompt template, truncating the student code to the budget
 
-        return generated_text
+        The whole formatted prompt is tokenized in one call: SentencePiece
+        adds a leading "▁" to every encode, so joining separately tokenized
+        pieces would not reproduce the fine-tuning template's ids.
+
+        Returns:
+            Tuple of (code as it appears in the prompt, prompt token ids)
+        """
+        prompt = template.format(code=code, level=student_level)
+        input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids
+        overflow = input_ids.shape[1] - max_input_tokens
+        if overflow <= 0:
+            return code, input_ids
+
+        # Cut the code, not the instructions, then re-tokenize the full
+        # prompt; merges at the cut can shift the count, so repeat if needed
+        code_ids = self.tokenizer(
+            code, return_tensors="pt", add_special_tokens=False).input_ids
+        if code_ids.shape[1] - overflow <= 0:
+            raise ValueError(
+                f"max_input_tokens={max_input_tokens} leaves no room for the code "
+                f"after the {input_ids.shape[1] - code_ids.shape[1]}-token prompt template")
+        while overflow > 0 and code_ids.shape[1] > 0:
+            code_budget = max(code_ids.shape[1] - overflow, 0)
+            code_ids = self._truncate_ids(code_ids, code_budget)
+            code = self.tokenizer.decode(code_ids[0], skip_special_tokens=True)
+            prompt = template.format(code=code, level=student_level)
+            input_ids = self.tokenizer(prompt, return_tensors="pt").input_ids
+            overflow = input_ids.shape[1] - max_input_tokens
+        return code, input_ids
+
+    def _truncate_ids(self, input_ids: torch.Tensor, max_length: int) -> torch.Tensor:
+        """Cut token ids to max_length, logging whenever truncation actually fires"""
+        if input_ids.shape[1] > max_length:
+            self.truncated_prompts += 1
+            logger.warning(
+                f"Prompt truncated from {input_ids.shape[1]} to {max_length} tokens "
+                f"({self.truncated_prompts} truncated so far)")
+            input_ids = input_ids[:, :max_length]
+        return input_ids
 
     def generate_educational_feedback(self, code: str, student_level: str = "beginner") -> str:
         """
@@ -317,26 +810,34 @@ Feedback:"""
         )
 
         # Tokenize input
-        inputs = self.tokenizer(
-            prompt, return_tensors="pt", truncation=True, max_length=2048)
+        input_ids = self._truncate_ids(
+            self.tokenizer(prompt, return_tensors="pt").input_ids, self.max_input_tokens)
 
         # Generate response
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs = self.model.generate(
-                inputs.input_ids,
+                input_ids,
                 max_new_tokens=512,
-                temperature=0.7,
-                do_sample=True,
+                do_sample=False,  # Greedy: deterministic, no sampling overhead
+                num_beams=1,
+                stop_strings=FEEDBACK_STOP_STRINGS,
+                tokenizer=self.tokenizer,
                 pad_token_id=self.tokenizer.eos_token_id
             )
 
-        # Decode response
-        response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+        # Decode only the generated part (after the prompt); slicing the ids
+        # avoids decoding the prompt just to drop it again
+        new_tokens = outputs[0, input_ids.shape[1]:]
+        generated_text = self.tokenizer.decode(new_tokens, skip_special_tokens=True)
 
-        # Extract only the generated part (after the prompt)
-        generated_text = response[len(prompt):].strip()
+        return self._strip_stop_strings(generated_text)
 
-        return generated_text
+    @staticmethod
+    def _strip_stop_strings(text: str) -> str:
+        """Cut generated text at the first stop string, if one was emitted"""
+        for stop in FEEDBACK_STOP_STRINGS:
+            text = text.split(stop, 1)[0]
+        return text.strip()
 
     def analyze_student_code(self, code: str, student_level: str = "beginner") -> List[CodeFeedback]:
         """
@@ -385,58 +886,110 @@ Feedback:"""
     def _fallback_analysis(self, code: str, student_level: str) -> List[CodeFeedback]:
         """Fallback analysis using rule-based methods if fine-tuned model fails"""
         feedback_list = []
+        facts = self._collect_code_facts(code)
 
         # Analyze syntax
-        syntax_feedback = self._check_syntax(code, student_level)
+        syntax_feedback = self._check_syntax(code, student_level, facts)
         if syntax_feedback:
             feedback_list.append(syntax_feedback)
 
         # Analyze logic and structure
-        logic_feedback = self._check_logic(code, student_level)
+        logic_feedback = self._check_logic(code, student_level, facts)
         if logic_feedback:
             feedback_list.extend(logic_feedback)
 
         # Check for optimization opportunities
-        optimization_feedback = self._check_optimization(code, student_level)
+        optimization_feedback = self._check_optimization(
+            code, student_level, facts)
         if optimization_feedback:
             feedback_list.append(optimization_feedback)
 
         # Provide style suggestions
-        style_feedback = self._check_style(code, student_level)
+        style_feedback = self._check_style(code, student_level, facts)
         if style_feedback:
             feedback_list.append(style_feedback)
 
         return feedback_list
 
-    def _check_syntax(self, code: str, student_level: str) -> Optional[CodeFeedback]:
-        """Check for syntax errors and provide educational feedback"""
-        # This would integrate with the fine-tuned model
-        # For now, using basic pattern matching as placeholder
+    def _collect_code_facts(self, code: str) -> Dict:
+        """
+        Gather the facts used by the rule-based checks
+
+        Parses the code once and walks the tree with _EducationVisitor; code
+        that does not parse (or is nested too deeply to parse or walk) is
+        scanned for substrings instead.
+        """
+        try:
+            tree = ast.parse(code)
+            visitor = _EducationVisitor()
+            visitor.visit(tree)
+        except (SyntaxError, ValueError, RecursionError) as e:
+            # ValueError: null bytes before Python 3.12
+            tokens = self._scan_fallback_tokens(code)
+            return {
+                "parsed": False,
+                "syntax_error": e if isinstance(e, SyntaxError) else None,
+                "infinite_loop": bool(tokens["while True:"] and not tokens["break"]),
+                "unused_names": ["x"] if tokens["x = "] and not tokens["x"] else [],
+                "nested_loops": tokens["for"] > 1 and tokens["in range"] > 1,
+                "short_names": bool(tokens["x = "] or tokens["x"] or tokens["y"] or tokens["z"]),
+                "undefined_names": [],
+                "unused_imports": [],
+                "zero_division": False,
+            }
 
-        common_syntax_errors = {
-            r"print\s*\([^)]*\)\s*$": "Remember to add a colon after print statements in some contexts",
-            r"if\s+[^:]+$": "Don't forget the colon after your if condition",
-            r"for\s+[^:]+$": "Don't forget the colon after your for loop",
+        return {
+            "parsed": True,
+            "syntax_error": None,
+            "infinite_loop": visitor.infinite_loops > 0,
+            "unused_names": sorted(visitor.unused_names()),
+            "undefined_names": sorted(visitor.undefined_names()),
+            "unused_imports": sorted(visitor.unused_imports()),
+            "zero_division": visitor.zero_divisions > 0,
+            "nested_loops": visitor.max_for_depth > 1,
+            "short_names": bool(visitor.short_names),
         }
 
-        for pattern, message in common_syntax_errors.items():
-            if re.search(pattern, code):
-                return CodeFeedback(
-                    code_snippet=code,
-                    feedback_type="syntax",
-                    feedback_message=message,
-                    difficulty_level=student_level,
-                    learning_objectives=["syntax", "basic_python"]
-                )
+    def _scan_fallback_tokens(self, code: str) -> Counter:
+        """Count the substrings used by the rule-based checks in one scan of the code"""
+        return Counter(match.group() for match in self._FALLBACK_TOKEN_RE.finditer(code))
 
-        return None
+    def _check_syntax(self, code: str, student_level: str,
+                      facts: Optional[Dict] = None) -> Optional[CodeFeedback]:
+        """Check for syntax errors and provide educational feedback"""
+        if facts is None:
+            facts = self._collect_code_facts(code)
+
+        error = facts["syntax_error"]
+        if error is None:
+            return None
+
+        # Explain common beginner mistakes on the offending line, otherwise
+        # report what the parser said
+        line = (error.text or "").rstrip()
+        message = f"Python couldn't understand line {error.lineno}: {error.msg}."
+        for pattern, hint in self._SYNTAX_PATTERNS:
+            if pattern.search(line):
+                message = hint
+                break
+
+        return CodeFeedback(
+            code_snippet=code,
+            feedback_type="syntax",
+            feedback_message=message,
+            difficulty_level=student_level,
+            learning_objectives=["syntax", "basic_python"]
+        )
 
-    def _check_logic(self, code: str, student_level: str) -> List[CodeFeedback]:
+    def _check_logic(self, code: str, student_level: str,
+                     facts: Optional[Dict] = None) -> List[CodeFeedback]:
         """Check for logical errors and provide educational feedback"""
         feedback_list = []
+        if facts is None:
+            facts = self._collect_code_facts(code)
 
         # Check for infinite loops
-        if "while True:" in code and "break" not in code:
+        if facts["infinite_loop"]:
             feedback_list.append(CodeFeedback(
                 code_snippet=code,
                 feedback_type="logic",
@@ -446,22 +999,64 @@ Feedback:"""
             ))
 
         # Check for unused variables
-        # This is a simplified check - the actual model would be more sophisticated
-        if "x = " in code and "x" not in code.replace("x = ", ""):
+        if facts["unused_names"]:
+            names = ", ".join(f"'{name}'" for name in facts["unused_names"])
+            if len(facts["unused_names"]) > 1:
+                message = f"You created variables {names} but didn't use them."
+            else:
+                message = f"You created variable {names} but didn't use it."
             feedback_list.append(CodeFeedback(
                 code_snippet=code,
                 feedback_type="logic",
-                feedback_message="You created variable 'x' but didn't use it. Consider removing unused variables to keep your code clean.",
+                feedback_message=f"{message} Consider removing unused variables to keep your code clean.",
                 difficulty_level=student_level,
                 learning_objectives=["variables", "code_cleanliness"]
             ))
 
+        # Check for names that are never defined or imported
+        if facts["undefined_names"]:
+            names = ", ".join(f"'{name}'" for name in facts["undefined_names"])
+            verb = "are" if len(facts["undefined_names"]) > 1 else "is"
+            feedback_list.append(CodeFeedback(
+                code_snippet=code,
+                feedback_type="logic",
+                feedback_message=f"{names} {verb} used but never defined or imported. Check the spelling or add the missing assignment or import.",
+                difficulty_level=student_level,
+                learning_objectives=["variables", "debugging"]
+            ))
+
+        # Check for imports that are never used
+        if facts["unused_imports"]:
+            names = ", ".join(f"'{name}'" for name in facts["unused_imports"])
+            pronoun = "them" if len(facts["unused_imports"]) > 1 else "it"
+            feedback_list.append(CodeFeedback(
+                code_snippet=code,
+                feedback_type="logic",
+                feedback_message=f"You imported {names} but never used {pronoun}. Remove unused imports to keep your code clean.",
+                difficulty_level=student_level,
+                learning_objectives=["imports", "code_cleanliness"]
+            ))
+
+        # Check for division by a literal zero
+        if facts["zero_division"]:
+            feedback_list.append(CodeFeedback(
+                code_snippet=code,
+                feedback_type="logic",
+                feedback_message="This code divides by zero, which raises a ZeroDivisionError when it runs. Check the divisor before dividing.",
+                difficulty_level=student_level,
+                learning_objectives=["arithmetic", "error_handling"]
+            ))
+
         return feedback_list
 
-    def _check_optimization(self, code: str, student_level: str) -> Optional[CodeFeedback]:
+    def _check_optimization(self, code: str, student_level: str,
+                            facts: Optional[Dict] = None) -> Optional[CodeFeedback]:
         """Check for optimization opportunities"""
+        if facts is None:
+            facts = self._collect_code_facts(code)
+
         # Check for nested loops that could be optimized
-        if code.count("for") > 1 and code.count("in range") > 1:
+        if facts["nested_loops"]:
             return CodeFeedback(
                 code_snippet=code,
                 feedback_type="optimization",
@@ -474,10 +1069,14 @@ Feedback:"""
 
         return None
 
-    def _check_style(self, code: str, student_level: str) -> Optional[CodeFeedback]:
+    def _check_style(self, code: str, student_level: str,
+                     facts: Optional[Dict] = None) -> Optional[CodeFeedback]:
         """Check for style improvements"""
+        if facts is None:
+            facts = self._collect_code_facts(code)
+
         # Check for meaningful variable names
-        if "x" in code or "y" in code or "z" in code:
+        if facts["short_names"]:
             return CodeFeedback(
                 code_snippet=code,
                 feedback_type="style",
@@ -514,15 +1113,25 @@ Feedback:"""
 
         return explanations.get(concept, {}).get(student_level, f"Explanation for {concept} at {student_level} level")
 
-    def _load_comprehensive_feedback_prompt(self) -> str:
-        """Load the comprehensive feedback prompt template"""
-        return """You are an expert programming tutor. Provide comprehensive educational feedback for the following student code.
+    @staticmethod
+    @functools.cache
+    def _load_shared_context_prompt() -> str:
+        """Load the context prefix shared by the comprehensive feedback prompts"""
+        return """You are an expert programming tutor.
 
 Student Code:
 {code}
 
 Student Level: {level}
 
+"""
+
+    @staticmethod
+    @functools.cache
+    def _load_comprehensive_feedback_prompt() -> str:
+        """Load the comprehensive feedback prompt template"""
+        return """Provide comprehensive educational feedback for the student code above.
+
 Please provide a detailed analysis in the following JSON format:
 
 {{
@@ -546,13 +1155,14 @@ Please provide a detailed analysis in the following JSON format:
 
 Focus on educational value and constructive feedback that helps the student learn and improve."""
 
-    def _load_comprehension_question_prompt(self) -> str:
+    @staticmethod
+    @functools.cache
+    def _load_comprehension_question_prompt() -> str:
         """Load the comprehension question generation prompt"""
         return """Based on the learning points and improvements discussed, generate a comprehension question to test the student's understanding.
 
 Learning Points: {learning_points}
 Code Issues: {issues}
-Student Level: {level}
 
 Generate a question that tests understanding of the key concepts discussed. The question should be appropriate for the student's level.
 
@@ -565,16 +1175,14 @@ Format your response as JSON:
 
 Make the question challenging but fair for the student's level."""
 
-    def _load_code_fix_prompt(self) -> str:
+    @staticmethod
+    @functools.cache
+    def _load_code_fix_prompt() -> str:
         """Load the code fix generation prompt"""
-        return """You are an expert programming tutor. Based on the analysis and learning points, provide an improved version of the student's code.
-
-Original Code:
-{code}
+        return """Based on the analysis and learning points, provide an improved version of the student code above.
 
 Issues Identified: {issues}
 Learning Points: {learning_points}
-Student Level: {level}
 
 Provide an improved version of the code that addresses the issues while maintaining educational value. Include comments to explain the improvements.
 
@@ -595,29 +1203,34 @@ Focus on educational improvements that help the student understand better practi
             student_level: Student's skill level
 
         Returns:
-            Adapted feedback
+            Adapted feedback (a new instance; feedback objects are immutable)
         """
         if student_level == "beginner":
             # Simplify language and add more examples
-            feedback.feedback_message = feedback.feedback_message.replace(
+            feedback = replace(feedback, feedback_message=feedback.feedback_message.replace(
                 "O(n²)", "quadratic time (slower)"
             ).replace(
                 "O(n)", "linear time (faster)"
-            )
+            ))
         elif student_level == "advanced":
             # Add more technical details
             if "optimization" in feedback.feedback_type:
-                feedback.feedback_message += " Consider the space-time tradeoff and cache locality."
+                feedback = replace(
+                    feedback,
+                    feedback_message=feedback.feedback_message
+                    + " Consider the space-time tradeoff and cache locality.")
 
         return feedback
 
-    def generate_comprehensive_feedback(self, code: str, student_level: str = "beginner") -> ComprehensiveFeedback:
+    def generate_comprehensive_feedback(self, code: str, student_level: str = "beginner",
+                                        streamer: Optional[TextIteratorStreamer] = None) -> ComprehensiveFeedback:
         """
         Generate comprehensive educational feedback with all components
 
         Args:
             code: Student's code to analyze
             student_level: Student's skill level
+            streamer: Optional streamer receiving the analysis tokens as they decode
 
         Returns:
             ComprehensiveFeedback object with all educational components
@@ -625,24 +1238,35 @@ Focus on educational improvements that help the student understand better practi
         if not self.model or not self.tokenizer:
             raise ValueError("Model not loaded. Call load_model() first.")
 
+        self.comprehensive_requests += 1
         try:
+            if self.clean_code_shortcut and self._is_clean_code(code):
+                self.clean_code_shortcuts += 1
+                logger.info(
+                    f"Clean code shortcut used ({self.clean_code_shortcuts} of "
+                    f"{self.comprehensive_requests} comprehensive requests)")
+                return self._create_clean_code_feedback(code, student_level)
+
+            # Prefill the shared instructions + code once and reuse the
+            # KV cache for all three generations below. Long code is cut
+            # here, leaving room in the budget for each task prompt.
+            prompt_code, prefix_ids = self._fit_prompt_to_budget(
+                self.shared_context_prompt, code, student_level,
+                self.max_input_tokens - self.TASK_PROMPT_TOKENS)
+            prefix_cache = self._build_prefix_cache(prefix_ids)
+
             # Step 1: Generate comprehensive analysis
             comprehensive_analysis = self._generate_comprehensive_analysis(
-                code, student_level)
-
-            # Step 2: Generate comprehension question
-            comprehension_data = self._generate_comprehension_question(
-                comprehensive_analysis["learning_points"],
-                comprehensive_analysis["issues"],
-                student_level
-            )
+                prompt_code, student_level, prefix_cache, streamer)
 
-            # Step 3: Generate improved code
-            code_fix_data = self._generate_code_fix(
-                code,
+            # Steps 2 and 3: Generate comprehension question and improved
+            # code together; both only depend on the analysis above
+            comprehension_data, code_fix_data = self._generate_question_and_fix(
+                prompt_code,
                 comprehensive_analysis["issues"],
                 comprehensive_analysis["learning_points"],
-                student_level
+                student_level,
+                prefix_cache
             )
 
             # Create comprehensive feedback object
@@ -670,36 +1294,65 @@ Focus on educational improvements that help the student understand better practi
             # Return a basic comprehensive feedback if model fails
             return self._create_fallback_comprehensive_feedback(code, student_level)
 
-    def _generate_comprehensive_analysis(self, code: str, student_level: str) -> Dict:
+    def stream_comprehensive_feedback(self, code: str, student_level: str = "beginner"
+                                      ) -> Iterator[Tuple[str, object]]:
+        """
+        Generate comprehensive feedback while streaming the analysis as it decodes
+
+        Yields ("analysis", text_chunk) items while the model writes the
+        analysis, then a final ("feedback", ComprehensiveFeedback) item.
+        """
+        if not self.model or not self.tokenizer:
+            raise ValueError("Model not loaded. Call load_model() first.")
+
+        streamer = TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        result = {}
+
+        def run():
+            try:
+                result["feedback"] = self.generate_comprehensive_feedback(
+                    code, student_level, streamer)
+            except Exception as e:
+                result["error"] = e
+            finally:
+                # Unblock the consumer when no generation ran (clean code
+                # shortcut or an early error); a second end() is harmless
+                streamer.end()
+
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+        for chunk in streamer:
+            yield "analysis", chunk
+        worker.join()
+        if "error" in result:
+            raise result["error"]
+        yield "feedback", result["feedback"]
+
+    def _generate_comprehensive_analysis(self, code: str, student_level: str,
+                                         prefix_cache: Optional[Tuple] = None,
+                                         streamer: Optional[TextIteratorStreamer] = None) -> Dict:
         """Generate comprehensive analysis using the fine-tuned model"""
-        prompt = self.comprehensive_feedback_prompt.format(
+        prefix = self.shared_context_prompt.format(
             code=code,
             level=student_level
         )
+        prompt = self.comprehensive_feedback_prompt
 
-        response = self._generate_model_response(prompt)
+        response = self._generate_model_response(
+            prompt, prefix, prefix_cache, streamer)
 
         try:
             # Try to parse JSON response
-            import json
-            return json.loads(response)
+            return parse_json(response)
         except json.JSONDecodeError:
             logger.warning("Failed to parse JSON response, using fallback")
             return self._create_fallback_analysis(code, student_level)
 
-    def _generate_comprehension_question(self, learning_points: List[str], issues: List[str], student_level: str) -> Dict:
-        """Generate comprehension question using the fine-tuned model"""
-        prompt = self.comprehension_question_prompt.format(
-            learning_points=", ".join(learning_points),
-            issues=", ".join(issues),
-            level=student_level
-        )
-
-        response = self._generate_model_response(prompt)
-
+    def _parse_comprehension_question(self, response: str) -> Dict:
+        """Parse the comprehension question JSON, falling back to a generic question"""
         try:
-            import json
-            return json.loads(response)
+            return parse_json(response)
         except json.JSONDecodeError:
             logger.warning(
                 "Failed to parse comprehension question JSON, using fallback")
@@ -709,20 +1362,10 @@ Focus on educational improvements that help the student understand better practi
                 "explanation": "This question tests your understanding of the key learning points discussed."
             }
 
-    def _generate_code_fix(self, code: str, issues: List[str], learning_points: List[str], student_level: str) -> Dict:
-        """Generate improved code using the fine-tuned model"""
-        prompt = self.code_fix_prompt.format(
-            code=code,
-            issues=", ".join(issues),
-            learning_points=", ".join(learning_points),
-            level=student_level
-        )
-
-        response = self._generate_model_response(prompt)
-
+    def _parse_code_fix(self, response: str) -> Dict:
+        """Parse the code fix JSON, falling back to a placeholder fix"""
         try:
-            import json
-            return json.loads(response)
+            return parse_json(response)
         except json.JSONDecodeError:
             logger.warning("Failed to parse code fix JSON, using fallback")
             return {
@@ -730,26 +1373,171 @@ Focus on educational improvements that help the student understand better practi
                 "fix_explanation": "This is a fallback improved version. The model should provide specific improvements."
             }
 
-    def _generate_model_response(self, prompt: str) -> str:
-        """Generate response from the fine-tuned model"""
-        inputs = self.tokenizer(
-            prompt, return_tensors="pt", truncation=True, max_length=2048)
+    def _generate_question_and_fix(self, code: str, issues: List[str], learning_points: List[str],
+                                   student_level: str, prefix_cache: Optional[Tuple] = None) -> Tuple[Dict, Dict]:
+        """Generate the comprehension question and code fix in one batched generate call"""
+        prefix = self.shared_context_prompt.format(
+            code=code,
+            level=student_level
+        )
+        # Both prompts list the same issues and learning points
+        issues_text = ", ".join(issues)
+        learning_points_text = ", ".join(learning_points)
+        question_prompt = self.comprehension_question_prompt.format(
+            learning_points=learning_points_text,
+            issues=issues_text
+        )
+        fix_prompt = self.code_fix_prompt.format(
+            issues=issues_text,
+            learning_points=learning_points_text
+        )
+
+        question_response, fix_response = self._generate_model_responses(
+            [question_prompt, fix_prompt], prefix, prefix_cache)
+
+        return self._parse_comprehension_question(question_response), self._parse_code_fix(fix_response)
+
+    def _build_prefix_cache(self, prefix_ids: torch.Tensor) -> Tuple[torch.Tensor, object]:
+        """
+        Run the prefill for a shared prompt prefix once
+
+        Args:
+            prefix_ids: Token ids of the prefix, already fit to the prompt budget
+
+        Returns:
+            Tuple of (prefix token ids, past_key_values) for _generate_model_response
+        """
+        # Passing a Cache object keeps the output a DynamicCache instead of
+        # the legacy tuple format some 4.x models convert back to
+        with torch.inference_mode():
+            past_key_values = self.model(
+                prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+
+        return prefix_ids, past_key_values
+
+    def _prompt_ids_after_prefix(self, prefix: str, prefix_ids: torch.Tensor,
+                                 prompts: List[str]) -> Optional[List[List[int]]]:
+        """
+        Token ids of each prompt as it follows the prefix in the full prompt
+
+        Prompts tokenized on their own gain a leading "▁" and merge
+        differently at the join, so the full texts are tokenized and the
+        cached prefix ids cut off. Returns None when a full tokenization
+        does not start with the prefix ids (the tokenizer merged across the
+        join), in which case the cache cannot be used. The prefix must be
+        the complete prefix string; truncation belongs in the code it
+        was formatted from (see _fit_prompt_to_budget).
+        """
+        prefix_list = prefix_ids[0].tolist()
+        full_ids = self.tokenizer([prefix + prompt for prompt in prompts]).input_ids
+        if any(ids[:len(prefix_list)] != prefix_list for ids in full_ids):
+            logger.warning("Prompt does not extend the cached prefix; skipping the cache")
+            return None
+        return [ids[len(prefix_list):] for ids in full_ids]
+
+    def _generate_model_response(self, prompt: str, prefix: str = "",
+                                 prefix_cache: Optional[Tuple] = None,
+                                 streamer: Optional[TextIteratorStreamer] = None) -> str:
+        """
+        Generate response from the fine-tuned model
+
+        Args:
+            prompt: Task-specific part of the prompt
+            prefix: Shared context placed before the prompt
+            prefix_cache: Output of _build_prefix_cache for the prefix, to skip its prefill
+            streamer: Optional streamer receiving the new tokens as they decode
+        """
+        return self._generate_model_responses([prompt], prefix, prefix_cache, streamer)[0]
+
+    def _generate_model_responses(self, prompts: List[str], prefix: str = "",
+                                  prefix_cache: Optional[Tuple] = None,
+                                  streamer: Optional[TextIteratorStreamer] = None) -> List[str]:
+        """
+        Generate responses for several prompts in a single batched generate call
+
+        Each prompt is placed after the same prefix. Sharing one forward pass
+        amortizes the weight loads of every decode step across the batch.
+        Streaming is only supported for a single prompt.
+        """
+        batch_size = len(prompts)
+        past_key_values = None
+        prompt_ids = None
+        if prefix_cache is not None:
+            prefix_ids, cached = prefix_cache
+            prompt_ids = self._prompt_ids_after_prefix(prefix, prefix_ids, prompts)
+        if prompt_ids is not None:
+            prompt_inputs = self.tokenizer.pad(
+                {"input_ids": prompt_ids}, return_tensors="pt")
+            # Padding sits between the prefix and each prompt; it is masked
+            # out and position ids are derived from the attention mask
+            input_ids = torch.cat(
+                [prefix_ids.expand(batch_size, -1), prompt_inputs.input_ids], dim=1)
+            attention_mask = torch.cat(
+                [torch.ones_like(prefix_ids).expand(batch_size, -1), prompt_inputs.attention_mask], dim=1)
+            past_key_values = self._expand_prefix_cache(cached, batch_size)
+        else:
+            inputs = self.tokenizer(
+                [prefix + prompt for prompt in prompts], return_tensors="pt",
+                padding=True, truncation=True, max_length=self.max_input_tokens)
+            input_ids, attention_mask = inputs.input_ids, inputs.attention_mask
 
         # Move to CPU if no GPU available
         if not torch.cuda.is_available():
-            inputs = {k: v.cpu() for k, v in inputs.items()}
-
-        with torch.no_grad():
+            input_ids = input_ids.cpu()
+            attention_mask = attention_mask.cpu()
+
+        # Speculative decoding: candidate tokens from a draft model, or else
+        # looked up from the prompt (the code fix echoes the student code),
+        # are verified in one forward pass. transformers only supports it
+        # for a batch of one.
+        speculative_kwargs = {}
+        if batch_size == 1:
+            if self.assistant_model is not None:
+                speculative_kwargs["assistant_model"] = self.assistant_model
+                # Starting draft length; transformers adapts it to the
+                # acceptance rate, and the fixed JSON keys accept well
+                speculative_kwargs["num_assistant_tokens"] = 5
+            else:
+                speculative_kwargs["prompt_lookup_num_tokens"] = 10
+
+        with torch.inference_mode():
             outputs = self.model.generate(
-                inputs.input_ids,
+                input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                streamer=streamer,
+                **speculative_kwargs,
                 max_new_tokens=512,
-                temperature=0.7,
-                do_sample=True,
+                # Greedy decoding keeps the JSON output well-formed far more
+                # often than sampling, avoiding wasted fallback generations
+                do_sample=False,
+                num_beams=1,
+                # Stop as soon as the JSON object is closed instead of
+                # always running to max_new_tokens
+                stopping_criteria=StoppingCriteriaList([
+                    JSONBalancedBracesCriteria(self.tokenizer, input_ids.shape[1])
+                ]),
                 pad_token_id=self.tokenizer.eos_token_id
             )
 
-        response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
-        return response[len(prompt):].strip()
+        # Decode only the new tokens; the prompt ids were built piecewise
+        # so its decoded text need not match the prompt string
+        new_tokens = outputs[:, input_ids.shape[1]:]
+        return [response.strip() for response in
+                self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)]
+
+    @staticmethod
+    def _expand_prefix_cache(past_key_values: DynamicCache, batch_size: int) -> DynamicCache:
+        """
+        Copy a batch-1 prefix cache out to batch_size rows
+
+        generate() extends the cache in place, so this always returns a fresh copy.
+        Uses only Cache methods, not the legacy tuple format removed in transformers 5.
+        """
+        cache = copy.deepcopy(past_key_values)
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        return cache
 
     def _create_fallback_analysis(self, code: str, student_level: str) -> Dict:
         """Create fallback analysis when model fails"""
@@ -772,6 +1560,42 @@ Focus on educational improvements that help the student understand better practi
             "estimated_time_to_improve": "10-15 minutes"
         }
 
+    def _is_clean_code(self, code: str) -> bool:
+        """Whether the code is short, parses, and triggers none of the rule-based checks"""
+        if code.count("\n") + 1 > self.CLEAN_CODE_MAX_LINES:
+            return False
+        facts = self._collect_code_facts(code)
+        return facts["parsed"] and not (
+            facts["infinite_loop"] or facts["unused_names"] or facts["undefined_names"]
+            or facts["unused_imports"] or facts["zero_division"]
+            or facts["nested_loops"] or facts["short_names"])
+
+    def _create_clean_code_feedback(self, code: str, student_level: str) -> ComprehensiveFeedback:
+        """Create comprehensive feedback for clean code without running the model"""
+        return ComprehensiveFeedback(
+            code_snippet=code,
+            student_level=student_level,
+            strengths=["Code parses without errors",
+                       "Descriptive variable names",
+                       "No unused variables or imports, undefined names or obvious logic problems"],
+            weaknesses=[],
+            issues=[],
+            step_by_step_improvement=["Add docstrings or comments explaining the intent",
+                                      "Write a few test cases, including edge cases"],
+            learning_points=["Testing with edge cases",
+                             "Documenting code for other readers"],
+            review_summary="Well done! The automated checks found no issues. "
+                           "Keep practicing by testing it with unusual inputs.",
+            comprehension_question="How would you check that this code handles edge cases such as empty input?",
+            comprehension_answer="Write test cases for edge inputs and compare the results with what you expect.",
+            explanation="Testing edge cases confirms the code works beyond the happy path.",
+            improved_code=code,
+            fix_explanation="No fixes needed; the code is unchanged.",
+            difficulty_level=student_level,
+            learning_objectives=["testing", "documentation"],
+            estimated_time_to_improve="5 minutes"
+        )
+
     def _create_fallback_comprehensive_feedback(self, code: str, student_level: str) -> ComprehensiveFeedback:
         """Create fallback comprehensive feedback when model fails"""
         fallback_analysis = self._create_fallback_analysis(code, student_level)
@@ -796,8 +1620,56 @@ Focus on educational improvements that help the student understand better practi
         )
 
 
-def main():
-    """Main function to demonstrate the system with fine-tuned model"""
+def format_comprehensive_feedback(feedback: ComprehensiveFeedback) -> str:
+    """Render comprehensive feedback as one report string for the console"""
+    def numbered(items: List[str], line_format: str = "   {i}. {item}") -> str:
+        return "\n".join(line_format.format(i=i, item=item)
+                         for i, item in enumerate(items, 1))
+
+    return "\n".join([
+        "\n📊 CODE ANALYSIS:",
+        "=" * 30,
+        "\n✅ STRENGTHS:",
+        numbered(feedback.strengths),
+        "\n❌ WEAKNESSES:",
+        numbered(feedback.weaknesses),
+        "\n⚠️ ISSUES:",
+        numbered(feedback.issues),
+        "\n📝 STEP-BY-STEP IMPROVEMENT GUIDE:",
+        "=" * 40,
+        numbered(feedback.step_by_step_improvement, "   Step {i}: {item}"),
+        "\n🎓 LEARNING POINTS:",
+        "=" * 25,
+        numbered(feedback.learning_points),
+        "\n📋 REVIEW SUMMARY:",
+        "=" * 20,
+        f"   {feedback.review_summary}",
+        "\n❓ COMPREHENSION QUESTION:",
+        "=" * 30,
+        f"   Question: {feedback.comprehension_question}",
+        f"   Answer: {feedback.comprehension_answer}",
+        f"   Explanation: {feedback.explanation}",
+        "\n🔧 IMPROVED CODE:",
+        "=" * 20,
+        feedback.improved_code,
+        "\n💡 FIX EXPLANATION:",
+        "=" * 20,
+        f"   {feedback.fix_explanation}",
+        "\n📊 METADATA:",
+        "=" * 15,
+        f"   Student Level: {feedback.student_level}",
+        f"   Learning Objectives: {', '.join(feedback.learning_objectives)}",
+        f"   Estimated Time to Improve: {feedback.estimated_time_to_improve}",
+    ])
+
+
+def main(verbose: bool = True):
+    """
+    Main function to demonstrate the system with fine-tuned model
+
+    Args:
+        verbose: Print the full comprehensive feedback report (disable for benchmarking)
+    """
     print("Generative AI for Programming Education")
     print("Using Fine-tuned CodeLlama-7B Model")
     print("=" * 50)
@@ -814,7 +1686,9 @@ def main():
     # Initialize the system with your fine-tuned model path
     # Update this path to point to your actual fine-tuned model
     model_path = r"C:\Users\farou\OneDrive - Aston University\finetunning"
-    ai_tutor = ProgrammingEducationAI(model_path)
+    # 4-bit NF4 lets the 7B model fit on 8GB lab GPUs
+    ai_tutor = ProgrammingEducationAI(
+        model_path, quantization="4bit" if torch.cuda.is_available() else None)
 
     try:
         # Load the fine-tuned model
@@ -831,6 +1705,9 @@ def main():
             print("System Memory after loading:")
             get_system_memory()
 
+        # Reserve inference memory up front, after the cache was cleared
+        ai_tutor.prewarm_cuda_allocator()
+
         # Example student code for testing
         student_code = """
 def find_duplicates(numbers):
@@ -888,56 +1765,8 @@ print(result)
             student_code, "beginner")
 
         # Display comprehensive feedback
-        print("\n📊 CODE ANALYSIS:")
-        print("="*30)
-
-        print("\n✅ STRENGTHS:")
-        for i, strength in enumerate(comprehensive_feedback.strengths, 1):
-            print(f"   {i}. {strength}")
-
-        print("\n❌ WEAKNESSES:")
-        for i, weakness in enumerate(comprehensive_feedback.weaknesses, 1):
-            print(f"   {i}. {weakness}")
-
-        print("\n⚠️ ISSUES:")
-        for i, issue in enumerate(comprehensive_feedback.issues, 1):
-            print(f"   {i}. {issue}")
-
-        print("\n📝 STEP-BY-STEP IMPROVEMENT GUIDE:")
-        print("="*40)
-        for i, step in enumerate(comprehensive_feedback.step_by_step_improvement, 1):
-            print(f"   Step {i}: {step}")
-
-        print("\n🎓 LEARNING POINTS:")
-        print("="*25)
-        for i, point in enumerate(comprehensive_feedback.learning_points, 1):
-            print(f"   {i}. {point}")
-
-        print("\n📋 REVIEW SUMMARY:")
-        print("="*20)
-        print(f"   {comprehensive_feedback.review_summary}")
-
-        print("\n❓ COMPREHENSION QUESTION:")
-        print("="*30)
-        print(f"   Question: {comprehensive_feedback.comprehension_question}")
-        print(f"   Answer: {comprehensive_feedback.comprehension_answer}")
-        print(f"   Explanation: {comprehensive_feedback.explanation}")
-
-        print("\n🔧 IMPROVED CODE:")
-        print("="*20)
-        print(comprehensive_feedback.improved_code)
-
-        print("\n💡 FIX EXPLANATION:")
-        print("="*20)
-        print(f"   {comprehensive_feedback.fix_explanation}")
-
-        print("\n📊 METADATA:")
-        print("="*15)
-        print(f"   Student Level: {comprehensive_feedback.student_level}")
-        print(
-            f"   Learning Objectives: {', '.join(comprehensive_feedback.learning_objectives)}")
-        print(
-            f"   Estimated Time to Improve: {comprehensive_feedback.estimated_time_to_improve}")
+        if verbose:
+            print(format_comprehensive_feedback(comprehensive_feedback))
 
     except Exception as e:
         print(f"Error: {e}")
@@ -946,4 +1775,9 @@ print(result)
 
 
 if __name__ == "__main__":
-    main()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Programming education feedback demo")
+    parser.add_argument("--quiet", action="store_true",
+                        help="skip printing the comprehensive feedback report")
+    main(verbose=not parser.parse_args().quiet)
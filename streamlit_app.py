@@ -4,6 +4,8 @@ Works on Hugging Face Spaces with fallback to demo mode
 Version: 2.0 - No Demo Fallback, Shows Detailed Errors
 """
 
+import importlib.util
+import threading
 import streamlit as st
 import os
 
@@ -14,20 +16,166 @@ st.set_page_config(
     layout="wide"
 )
 
-# Try to import the fine-tuned model components
-try:
-    from fine import ProgrammingEducationAI, ComprehensiveFeedback
-    MODEL_AVAILABLE = True
-except Exception as e:
-    MODEL_AVAILABLE = False
+# Only probe for the fine-tuned model module here; importing it pulls in
+# torch and transformers, which is deferred until the model is first used
+MODEL_AVAILABLE = importlib.util.find_spec("fine") is not None
 
 # Note: Using public model - no HF_TOKEN required
 HF_TOKEN = None  # Set to None for public model
 
+# Use Hugging Face Model Hub
+# Replace with your actual model name
+MODEL_PATH = "FaroukTomori/codellama-7b-programming-education"
+# Precision label -> ProgrammingEducationAI quantization argument
+_PRECISIONS = {"bf16": None, "8bit": "8bit", "4bit": "4bit"}
+
+
+@st.cache_resource
+def _available_precisions():
+    """
+    Precision labels this machine can load
+
+    The quantized ones use bitsandbytes, which needs a CUDA GPU; offering
+    them on a CPU Space would only fail after the loaded model was dropped.
+    torch is imported only when bitsandbytes is installed.
+    """
+    if importlib.util.find_spec("bitsandbytes") is None:
+        return ("bf16",)
+    import torch
+
+    if not torch.cuda.is_available():
+        return ("bf16",)
+    return tuple(_PRECISIONS)
+
+
+_PRECISION_OPTIONS = _available_precisions()
+# Default precision from MODEL_QUANTIZATION ("bf16", "8bit" or "4bit"), e.g.
+# to fit the 7B model on a small GPU Space
+DEFAULT_PRECISION = os.getenv("MODEL_QUANTIZATION") or "bf16"
+if DEFAULT_PRECISION not in _PRECISION_OPTIONS:
+    print(f"MODEL_QUANTIZATION={DEFAULT_PRECISION!r} is unknown or needs "
+          f"bitsandbytes and a GPU, using bf16")
+    DEFAULT_PRECISION = "bf16"
+MODEL_QUANTIZATION = _PRECISIONS[DEFAULT_PRECISION]
+
+# Widget options, built once instead of on every rerun
+_TAB_LABELS = ("✅ Strengths", "❌ Weaknesses", "🚨 Issues",
+               "📈 Improvements", "🎓 Learning", "❓ Questions", "🔧 Code Fix")
+_MODEL_OPTIONS = ("Use Demo Mode", "Use Fine-tuned Model")
+_STUDENT_LEVELS = ("beginner", "intermediate", "advanced")
+
+
+@st.cache_resource
+def _model_slot():
+    """
+    Process-wide record of which model the cache holds
+
+    Kept in a cached resource because Streamlit re-executes this script,
+    and with it any module-level state, on every rerun.
+    """
+    return {"key": None, "lock": threading.Lock()}
+
+
+@st.cache_resource(max_entries=1,
+                   show_spinner="🚀 Loading fine-tuned model (this may take 5-10 minutes on HF Spaces)...")
+def _load_ai_tutor(model_path: str, quantization: str = None):
+    """Construct and load the fine-tuned model"""
+    from fine import ProgrammingEducationAI
+
+    ai_tutor = ProgrammingEducationAI(model_path, quantization=quantization)
+    ai_tutor.load_model()
+    return ai_tutor
+
+
+def get_ai_tutor(model_path: str, quantization: str = None):
+    """Load the fine-tuned model once per process and share it across sessions"""
+    slot = _model_slot()
+    key = (model_path, quantization)
+    # One load at a time: the startup prefetch and a session picking another
+    # precision must not build two 7B models side by side
+    with slot["lock"]:
+        if slot["key"] not in (None, key):
+            # Streamlit only evicts after computing the new entry, so drop
+            # the old model and return its memory before loading the next
+            from fine import clear_cuda_cache
+
+            _load_ai_tutor.clear()
+            slot["key"] = None
+            clear_cuda_cache()
+        ai_tutor = _load_ai_tutor(model_path, quantization)
+        slot["key"] = key
+        return ai_tutor
+
+
+@st.cache_resource
+def start_model_prefetch():
+    """Start loading the model in the background once per process"""
+    def prefetch():
+        try:
+            get_ai_tutor(MODEL_PATH, MODEL_QUANTIZATION)
+        except Exception as e:
+            # Not cached; the first click retries and shows the error
+            print(f"Background model load failed: {e}")
+
+    thread = threading.Thread(target=prefetch, daemon=True)
+    thread.start()
+    return thread
+
+
+# Overlap the slow download/load with the user reading the page, so the
+# first "Analyze Code" click finds the model ready (PREFETCH_MODEL=0 disables)
+if MODEL_AVAILABLE and os.getenv("PREFETCH_MODEL", "1") != "0":
+    start_model_prefetch()
+
 
 # Demo feedback function removed - app now shows actual errors instead of falling back to demo
 
 
+def _bulleted(items, line_format="• {item}"):
+    """Join a feedback list into one markdown block (one widget instead of one per item)"""
+    return "\n\n".join(line_format.format(i=i, item=item)
+                       for i, item in enumerate(items, 1))
+
+
+def render_feedback(feedback):
+    """Display comprehensive feedback in one tab per section"""
+    tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs(_TAB_LABELS)
+
+    with tab1:
+        st.subheader("✅ Code Strengths")
+        st.markdown(_bulleted(feedback.strengths))
+
+    with tab2:
+        st.subheader("❌ Areas for Improvement")
+        st.markdown(_bulleted(feedback.weaknesses))
+
+    with tab3:
+        st.subheader("🚨 Issues to Address")
+        st.markdown(_bulleted(feedback.issues))
+
+    with tab4:
+        st.subheader("📈 Step-by-Step Improvements")
+        st.markdown(_bulleted(feedback.step_by_step_improvement,
+                              "**Step {i}:** {item}"))
+
+    with tab5:
+        st.subheader("🎓 Key Learning Points")
+        st.markdown(_bulleted(feedback.learning_points))
+
+    with tab6:
+        st.subheader("❓ Comprehension Questions")
+        st.markdown(
+            f"**Question:** {feedback.comprehension_question}\n\n"
+            f"**Answer:** {feedback.comprehension_answer}\n\n"
+            f"**Explanation:** {feedback.explanation}")
+
+    with tab7:
+        st.subheader("🔧 Improved Code")
+        st.code(feedback.improved_code, language="python")
+        st.markdown("**What Changed:**")
+        st.info(feedback.fix_explanation)
+
+
 def main():
     st.title("🤖 AI Programming Tutor")
     st.markdown("### Enhancing Programming Education with Generative AI")
@@ -39,9 +187,17 @@ def main():
         if MODEL_AVAILABLE:
             model_option = st.selectbox(
                 "Choose Model:",
-                ["Use Demo Mode", "Use Fine-tuned Model"],
+                _MODEL_OPTIONS,
                 help="Demo mode works immediately. Fine-tuned model requires loading."
             )
+            precision = st.selectbox(
+                "Model Precision:",
+                _PRECISION_OPTIONS,
+                index=_PRECISION_OPTIONS.index(DEFAULT_PRECISION),
+                help="4bit/8bit are listed when bitsandbytes and a GPU are available; "
+                     "changing it reloads the model"
+            )
+            quantization = _PRECISIONS[precision]
         else:
             model_option = "Use Demo Mode"
             st.warning("⚠️ Fine-tuned model not available - using demo mode")
@@ -50,7 +206,7 @@ def main():
 
         student_level = st.selectbox(
             "Student Level:",
-            ["beginner", "intermediate", "advanced"],
+            _STUDENT_LEVELS,
             help="Adjusts feedback complexity"
         )
 
@@ -74,16 +230,12 @@ def main():
             st.success("🌐 Using public model - no authentication required")
 
             # Show current model path
-            st.info(f"📁 Model path: FaroukTomori/codellama-7b-programming-education")
-
-            # Show if model is loaded in session
-            if 'ai_tutor' in st.session_state:
-                st.success("✅ Model loaded in session")
-            else:
-                st.info("⏳ Model not loaded yet - will load when you analyze code")
+            st.info(f"📁 Model path: {MODEL_PATH}")
+            st.info(f"🗜️ Precision: {precision}")
+            st.info("⏳ Model loads on the first analysis and is shared by all sessions")
         else:
             st.error("❌ Fine-tuned model not available")
-            st.error("🔍 Check the import error above to fix the issue")
+            st.error("🔍 fine.py was not found next to this app")
 
     # Main content
     st.markdown("---")
@@ -104,62 +256,45 @@ def main():
         with st.spinner("🤖 Analyzing your code..."):
             try:
                 if model_option == "Use Fine-tuned Model" and MODEL_AVAILABLE:
-                    # Check if model is already loaded
-                    if 'ai_tutor' not in st.session_state:
-                        with st.spinner("🚀 Loading fine-tuned model (this may take 5-10 minutes on HF Spaces)..."):
-                            try:
-                                # Use Hugging Face Model Hub
-                                # Replace with your actual model name
-                                model_path = "FaroukTomori/codellama-7b-programming-education"
-
-                                # Using public model - no authentication required
-                                st.info(
-                                    "🌐 Using public model - no authentication required")
-
-                                st.info(
-                                    f"🔍 Attempting to load model from: {model_path}")
-
-                                ai_tutor = ProgrammingEducationAI(model_path)
-                                st.success(
-                                    "✅ Model class instantiated successfully")
-
-                                ai_tutor.load_model()
-                                st.session_state['ai_tutor'] = ai_tutor
-                                st.success(
-                                    "✅ Fine-tuned model loaded successfully!")
-                            except Exception as e:
-                                st.error(f"❌ Error loading model: {e}")
-                                st.error("🔍 Full error details:")
-                                st.code(str(e), language="text")
-                                st.info(
-                                    "💡 Check the error above to fix the model loading issue")
-                                return  # Stop here and show the error
-
-                    if 'ai_tutor' in st.session_state:
-                        # Use fine-tuned model
-                        try:
-                            feedback = st.session_state['ai_tutor'].generate_comprehensive_feedback(
-                                code_input, student_level)
-                            st.success(
-                                "✅ Feedback generated using fine-tuned model!")
-                        except Exception as e:
-                            st.error(f"❌ Error generating feedback: {e}")
-                            st.error("🔍 Full error details:")
-                            st.code(str(e), language="text")
-                            st.info(
-                                "💡 Check the error above to fix the feedback generation issue")
-                            return
-                    else:
-                        # Model failed to load - show error instead of falling back
-                        st.error(
-                            "❌ Model failed to load - cannot generate feedback")
-                        st.info("💡 Fix the model loading error above first")
+                    # Loaded once per process; failures are not cached,
+                    # so the next click retries
+                    try:
+                        ai_tutor = get_ai_tutor(MODEL_PATH, quantization)
+                    except Exception as e:
+                        st.error(f"❌ Error loading model: {e}")
+                        st.error("🔍 Full error details:")
+                        st.code(str(e), language="text")
+                        st.info(
+                            "💡 Check the error above to fix the model loading issue")
+                        return  # Stop here and show the error
+
+                    # Use fine-tuned model, showing the analysis as it is
+                    # generated instead of only a spinner
+                    try:
+                        live_output = st.empty()
+                        streamed_text = ""
+                        for section, value in ai_tutor.stream_comprehensive_feedback(
+                                code_input, student_level):
+                            if section == "analysis":
+                                streamed_text += value
+                                live_output.code(streamed_text, language="json")
+                            else:
+                                feedback = value
+                        live_output.empty()
+                        st.success(
+                            "✅ Feedback generated using fine-tuned model!")
+                    except Exception as e:
+                        st.error(f"❌ Error generating feedback: {e}")
+                        st.error("🔍 Full error details:")
+                        st.code(str(e), language="text")
+                        st.info(
+                            "💡 Check the error above to fix the feedback generation issue")
                         return
                 else:
                     # Model not available or not selected - show error
                     if not MODEL_AVAILABLE:
                         st.error("❌ Fine-tuned model components not available")
-                        st.error("🔍 Check the import error in the sidebar")
+                        st.error("🔍 fine.py was not found next to this app")
                         return
                     else:
                         st.error(
@@ -168,48 +303,7 @@ def main():
                         return
 
                 # Display AI feedback in tabs
-                tab1, tab2, tab3, tab4, tab5, tab6, tab7 = st.tabs([
-                    "✅ Strengths", "❌ Weaknesses", "🚨 Issues",
-                    "📈 Improvements", "🎓 Learning", "❓ Questions", "🔧 Code Fix"
-                ])
-
-                with tab1:
-                    st.subheader("✅ Code Strengths")
-                    for strength in feedback.strengths:
-                        st.markdown(f"• {strength}")
-
-                with tab2:
-                    st.subheader("❌ Areas for Improvement")
-                    for weakness in feedback.weaknesses:
-                        st.markdown(f"• {weakness}")
-
-                with tab3:
-                    st.subheader("🚨 Issues to Address")
-                    for issue in feedback.issues:
-                        st.markdown(f"• {issue}")
-
-                with tab4:
-                    st.subheader("📈 Step-by-Step Improvements")
-                    for i, step in enumerate(feedback.step_by_step_improvement, 1):
-                        st.markdown(f"**Step {i}:** {step}")
-
-                with tab5:
-                    st.subheader("🎓 Key Learning Points")
-                    for point in feedback.learning_points:
-                        st.markdown(f"• {point}")
-
-                with tab6:
-                    st.subheader("❓ Comprehension Questions")
-                    st.markdown(
-                        f"**Question:** {feedback.comprehension_question}")
-                    st.markdown(f"**Answer:** {feedback.comprehension_answer}")
-                    st.markdown(f"**Explanation:** {feedback.explanation}")
-
-                with tab7:
-                    st.subheader("🔧 Improved Code")
-                    st.code(feedback.improved_code, language="python")
-                    st.markdown("**What Changed:**")
-                    st.info(feedback.fix_explanation)
+                render_feedback(feedback)
 
                 st.success(
                     "✅ Analysis complete! Review each tab for comprehensive feedback.")